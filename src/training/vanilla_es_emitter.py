@@ -22,14 +22,17 @@ class NoveltyArchive(flax.struct.PyTreeNode):
     """Novelty Archive used by NS-ES.
 
     Args:
-        archive: content of the archive
+        archive: content of the archive, stored column-wise with shape
+            (num_descriptors, size)
         size: total size of the archive
         position: current position in the archive
+        num_filled: number of filled slots in the archive, saturating at size
     """
 
     archive: jnp.ndarray
     size: int = flax.struct.field(pytree_node=False)
     position: jnp.ndarray = flax.struct.field()
+    num_filled: jnp.ndarray = flax.struct.field()
 
     @classmethod
     def init(
@@ -37,31 +40,48 @@ class NoveltyArchive(flax.struct.PyTreeNode):
         size: int,
         num_descriptors: int,
     ) -> NoveltyArchive:
-        archive = jnp.zeros((size, num_descriptors))
-        return cls(archive=archive, size=size, position=jnp.array(0, dtype=int))
+        archive = jnp.zeros((num_descriptors, size))
+        return cls(
+            archive=archive,
+            size=size,
+            position=jnp.array(0, dtype=int),
+            num_filled=jnp.array(0, dtype=int),
+        )
 
     @jax.jit
     def update(
         self,
-        descriptor: Descriptor,
+        descriptors: Descriptor,
     ) -> NoveltyArchive:
-        """Update the content of the novelty archive with newly generated descriptor.
+        """Update the content of the novelty archive with a batch of newly
+        generated descriptors, written in one go as a ring buffer.
 
         Args:
-            descriptor: new descriptor generated by NS-ES
+            descriptors: new descriptors generated by NS-ES, with shape
+                (batch_size, num_descriptors)
         Returns:
             The updated NoveltyArchive
         """
 
-        new_archive = jax.lax.dynamic_update_slice_in_dim(
-            self.archive,
-            descriptor,
-            self.position,
-            axis=0,
-        )
-        new_position = (self.position + 1) % self.size
+        # Only the last size descriptors of a larger batch would remain after
+        # wrapping around, keep them alone so that the slots to write are unique
+        batch_size = descriptors.shape[0]
+        num_kept = min(batch_size, self.size)
+        descriptors = descriptors[batch_size - num_kept :]
+
+        # Slots to write, wrapping around the end of the archive
+        slots = (
+            self.position + batch_size - num_kept + jnp.arange(num_kept)
+        ) % self.size
+
+        new_archive = self.archive.at[:, slots].set(descriptors.T)
+        new_position = (self.position + batch_size) % self.size
+        new_num_filled = jnp.minimum(self.num_filled + batch_size, self.size)
         return NoveltyArchive(
-            archive=new_archive, size=self.size, position=new_position
+            archive=new_archive,
+            size=self.size,
+            position=new_position,
+            num_filled=new_num_filled,
         )
 
     @partial(jax.jit, static_argnames=("num_nearest_neighbors",))
@@ -80,26 +100,43 @@ class NoveltyArchive(flax.struct.PyTreeNode):
             the novelty of each descriptor in descriptors.
         """
 
-        # Compute all distances with archive content
-        def distance(x: jnp.ndarray, y: jnp.ndarray) -> jnp.ndarray:
-            return jnp.sqrt(jnp.sum(jnp.square(x - y)))
-
-        distances = jax.vmap(
-            jax.vmap(partial(distance), in_axes=(None, 0)), in_axes=(0, None)
-        )(descriptors, self.archive)
-
-        # Filter distance with empty slot of archive
-        indices = jnp.arange(0, self.size, step=1) < self.position + 1
-        distances = jax.vmap(lambda distance: jnp.where(indices, distance, jnp.inf))(
-            distances
+        # Compute all distances with archive content, expanding the square
+        # |x - y|^2 = |x|^2 + |y|^2 - 2 x.y so that it reduces to one matmul.
+        # The es-samples are close to each other and to the latest archive
+        # entries, so expand around their mean to avoid cancellation
+        reference = jnp.mean(descriptors, axis=0)
+        centered_descriptors = descriptors - reference
+        centered_archive = self.archive - reference[:, None]
+        sq_distances = (
+            jnp.sum(jnp.square(centered_descriptors), axis=-1, keepdims=True)
+            + jnp.sum(jnp.square(centered_archive), axis=0)[None, :]
+            - 2.0 * centered_descriptors @ centered_archive
         )
 
-        # Find k nearest neighbours
-        _, indices = jax.lax.top_k(-distances, num_nearest_neighbors)
+        # Filter distance with empty slot of archive, with a single select
+        # broadcasting the validity mask over all descriptors. The filled
+        # slots and the next one to write are valid, all of them once the
+        # archive has wrapped around
+        num_valid = jnp.minimum(self.num_filled + 1, self.size)
+        valid = jnp.arange(self.size) < num_valid
+        sq_distances = jnp.where(valid[None, :], sq_distances, jnp.inf)
+
+        # Find k nearest neighbours, the square root being monotonic the
+        # ranking can be done on squared distances
+        _, indices = jax.lax.top_k(-sq_distances, num_nearest_neighbors)
+
+        # Recompute the exact distance to the k selected neighbours only
+        neighbors = jnp.take(self.archive, indices, axis=1)
+        distances = jnp.sqrt(
+            jnp.sum(jnp.square(neighbors - descriptors.T[:, :, None]), axis=0)
+        )
 
-        # Compute novelty as average distance with k neirest neirghbours
-        distances = jnp.where(distances == jnp.inf, jnp.nan, distances)
-        novelty = jnp.nanmean(jnp.take_along_axis(distances, indices, axis=1), axis=1)
+        # Compute novelty as average distance with k neirest neirghbours,
+        # the filled slots being sorted first, only the leading ones are valid
+        num_neighbors = jnp.minimum(num_nearest_neighbors, num_valid)
+        neighbors_mask = jnp.arange(num_nearest_neighbors) < num_neighbors
+        distances = jnp.where(neighbors_mask, distances, 0.0)
+        novelty = jnp.sum(distances, axis=1) / num_neighbors
         return novelty
 
 
@@ -148,6 +185,180 @@ class VanillaESEmitterState(EmitterState):
     random_key: RNGKey
 
 
+def _fitness_scores(
+    fitnesses: Fitness,
+    descriptors: Descriptor,
+    novelty_archive: NoveltyArchive,
+) -> jnp.ndarray:
+    """ES scores: the fitnesses of the es-samples."""
+    return fitnesses
+
+
+def _novelty_scores(
+    fitnesses: Fitness,
+    descriptors: Descriptor,
+    novelty_archive: NoveltyArchive,
+    novelty_fn: Callable[[NoveltyArchive, Descriptor], jnp.ndarray],
+) -> jnp.ndarray:
+    """NSES scores: the novelty of the es-samples in the novelty archive."""
+    return novelty_fn(novelty_archive, descriptors)
+
+
+def _build_es_step(
+    config: VanillaESConfig,
+    scoring_fn: Callable[
+        [Genotype, RNGKey], Tuple[Fitness, Descriptor, ExtraScores, RNGKey]
+    ],
+    scores_fn: Callable[[Fitness, Descriptor, NoveltyArchive], jnp.ndarray],
+    optimizer: optax.GradientTransformation,
+) -> Callable[
+    [Genotype, optax.OptState, RNGKey, NoveltyArchive],
+    Tuple[Genotype, optax.OptState, RNGKey],
+]:
+    """Build the main es component for a given config. The sampling and
+    ranking variants are selected here, so that the returned function
+    is specialised for the config and has no config branch in its trace.
+
+    Args:
+        config: algorithm config.
+        scoring_fn: used to evaluate the samples for the gradient estimate.
+        scores_fn: used to infer the score of the es-samples from their
+            fitnesses and descriptors.
+        optimizer: used to apply the approximated gradients.
+
+    Returns:
+        The es step function.
+    """
+
+    total_sample_number = config.sample_number
+    sample_sigma = config.sample_sigma
+    l2_coefficient = config.l2_coefficient
+
+    # Mirror sampling, each noise is followed by its opposite
+    if config.sample_mirror:
+        sample_number = total_sample_number // 2
+
+        def mirror_noise(noise: Genotype) -> Genotype:
+            return jax.tree_util.tree_map(
+                lambda x: jnp.reshape(
+                    jnp.stack([x, -x], axis=1), (2 * sample_number, *x.shape[1:])
+                ),
+                noise,
+            )
+
+        def fold_ranks(ranks: jnp.ndarray) -> jnp.ndarray:
+            ranks = jnp.reshape(ranks, (sample_number, 2))
+            return ranks[:, 0] - ranks[:, 1]
+
+    # Non-mirror sampling
+    else:
+        sample_number = total_sample_number
+
+        def mirror_noise(noise: Genotype) -> Genotype:
+            return noise
+
+        def fold_ranks(ranks: jnp.ndarray) -> jnp.ndarray:
+            return ranks
+
+    # Rank, with or without normalisation
+    if config.sample_rank_norm:
+
+        def rank_scores(scores: jnp.ndarray) -> jnp.ndarray:
+            ranking_indices = jnp.argsort(scores, axis=0)
+            ranks = (
+                jnp.empty_like(ranking_indices)
+                .at[ranking_indices]
+                .set(jnp.arange(total_sample_number))
+            )
+            return (ranks / (total_sample_number - 1)) - 0.5
+
+    else:
+
+        def rank_scores(scores: jnp.ndarray) -> jnp.ndarray:
+            return scores
+
+    def es_step(
+        parent: Genotype,
+        optimizer_state: optax.OptState,
+        random_key: RNGKey,
+        novelty_archive: NoveltyArchive,
+    ) -> Tuple[Genotype, optax.OptState, RNGKey]:
+        """Main es component, given a parent, return its
+        approximated-gradient-generated offspring.
+
+        Args:
+            parent: the considered parent.
+            optimizer_state: current optimizer state.
+            random_key
+            novelty_archive: archive used to compute the novelty for NSES.
+
+        Returns:
+            The approximated-gradients-generated offspring and a new random_key.
+        """
+
+        random_key, subkey = jax.random.split(random_key)
+
+        # Sampling noise, with an independent key for each leaf of the parent
+        leaves, treedef = jax.tree_util.tree_flatten(parent)
+        keys = jax.random.split(subkey, len(leaves))
+        gradient_noise = jax.tree_util.tree_unflatten(
+            treedef,
+            [
+                jax.random.normal(key=key, shape=(sample_number, *x.shape[1:]))
+                for key, x in zip(keys, leaves)
+            ],
+        )
+        sample_noise = mirror_noise(gradient_noise)
+
+        # Applying noise, the parent leading dimension of size 1 broadcasts
+        # against the sample dimension of the noise
+        samples = jax.tree_map(
+            lambda mean, noise: mean + sample_sigma * noise,
+            parent,
+            sample_noise,
+        )
+
+        # Evaluating samples
+        fitnesses, descriptors, extra_scores, random_key = scoring_fn(
+            samples, random_key
+        )
+
+        # Computing rank
+        scores = scores_fn(fitnesses, descriptors, novelty_archive)
+        ranks = rank_scores(scores)
+
+        # Reshaping rank to match the sample dimension of genotype_noise
+        ranks = jnp.ravel(fold_ranks(ranks))
+
+        # Computing the gradients as the rank-weighted sum of the noise
+        gradient = jax.tree_map(
+            lambda noise, p: jnp.reshape(
+                -jnp.tensordot(ranks, noise, axes=1)
+                / (total_sample_number * sample_sigma),
+                p.shape,
+            ),
+            gradient_noise,
+            parent,
+        )
+
+        # Adding regularisation
+        gradient = jax.tree_map(
+            lambda g, p: g + l2_coefficient * p,
+            gradient,
+            parent,
+        )
+
+        # Applying gradients
+        (offspring_update, optimizer_state) = optimizer.update(
+            gradient, optimizer_state
+        )
+        offspring = optax.apply_updates(parent, offspring_update)
+
+        return offspring, optimizer_state, random_key
+
+    return es_step
+
+
 class VanillaESEmitter(Emitter):
     """
     Emitter allowing to reproduce an ES or NSES emitter with
@@ -187,6 +398,24 @@ class VanillaESEmitter(Emitter):
         else:
             self._optimizer = optax.sgd(learning_rate=config.learning_rate)
 
+        # Select the scores used by the es process once, so that its
+        # identity stays the same across calls. For NSES, the number of
+        # nearest neighbours is bound once so that novelty is never retraced
+        # for a new k
+        if self._config.nses_emitter:
+            self._novelty_fn = partial(
+                NoveltyArchive.novelty,
+                num_nearest_neighbors=config.novelty_nearest_neighbors,
+            )
+            self._scores_fn = partial(_novelty_scores, novelty_fn=self._novelty_fn)
+        else:
+            self._scores_fn = _fitness_scores
+
+        # Build the es process specialised for the config
+        self._es_step = jax.jit(
+            _build_es_step(config, scoring_fn, self._scores_fn, self._optimizer)
+        )
+
     @property
     def batch_size(self) -> int:
         """
@@ -261,137 +490,6 @@ class VanillaESEmitter(Emitter):
 
         return emitter_state.offspring, random_key
 
-    @partial(
-        jax.jit,
-        static_argnames=("self", "scores_fn"),
-    )
-    def _es_emitter(
-        self,
-        parent: Genotype,
-        optimizer_state: optax.OptState,
-        random_key: RNGKey,
-        scores_fn: Callable[[Fitness, Descriptor], jnp.ndarray],
-    ) -> Tuple[Genotype, optax.OptState, RNGKey]:
-        """Main es component, given a parent and a way to infer the score from
-        the fitnesses and descriptors fo its es-samples, return its
-        approximated-gradient-generated offspring.
-
-        Args:
-            parent: the considered parent.
-            scores_fn: a function to infer the score of its es-samples from
-                their fitness and descriptors.
-            random_key
-
-        Returns:
-            The approximated-gradients-generated offspring and a new random_key.
-        """
-
-        random_key, subkey = jax.random.split(random_key)
-
-        # Sampling mirror noise
-        total_sample_number = self._config.sample_number
-        if self._config.sample_mirror:
-
-            sample_number = total_sample_number // 2
-            half_sample_noise = jax.tree_util.tree_map(
-                lambda x: jax.random.normal(
-                    key=subkey,
-                    shape=jnp.repeat(x, sample_number, axis=0).shape,
-                ),
-                parent,
-            )
-            sample_noise = jax.tree_util.tree_map(
-                lambda x: jnp.concatenate(
-                    [jnp.expand_dims(x, axis=1), jnp.expand_dims(-x, axis=1)], axis=1
-                ).reshape(jnp.repeat(x, 2, axis=0).shape),
-                half_sample_noise,
-            )
-            gradient_noise = half_sample_noise
-
-        # Sampling non-mirror noise
-        else:
-            sample_number = total_sample_number
-            sample_noise = jax.tree_map(
-                lambda x: jax.random.normal(
-                    key=subkey,
-                    shape=jnp.repeat(x, sample_number, axis=0).shape,
-                ),
-                parent,
-            )
-            gradient_noise = sample_noise
-
-        # Applying noise
-        samples = jax.tree_map(
-            lambda x: jnp.repeat(x, total_sample_number, axis=0),
-            parent,
-        )
-        samples = jax.tree_map(
-            lambda mean, noise: mean + self._config.sample_sigma * noise,
-            samples,
-            sample_noise,
-        )
-
-        # Evaluating samples
-        fitnesses, descriptors, extra_scores, random_key = self._scoring_fn(
-            samples, random_key
-        )
-
-        # Computing rank, with or without normalisation
-        scores = scores_fn(fitnesses, descriptors)
-
-        if self._config.sample_rank_norm:
-            ranking_indices = jnp.argsort(scores, axis=0)
-            ranks = jnp.argsort(ranking_indices, axis=0)
-            ranks = (ranks / (total_sample_number - 1)) - 0.5
-
-        else:
-            ranks = scores
-
-        # Reshaping rank to match shape of genotype_noise
-        if self._config.sample_mirror:
-            ranks = jnp.reshape(ranks, (sample_number, 2))
-            ranks = jnp.apply_along_axis(lambda rank: rank[0] - rank[1], 1, ranks)
-        ranks = jax.tree_map(
-            lambda x: jnp.reshape(
-                jnp.repeat(ranks.ravel(), x[0].ravel().shape[0], axis=0), x.shape
-            ),
-            gradient_noise,
-        )
-
-        # Computing the gradients
-        gradient = jax.tree_map(
-            lambda noise, rank: jnp.multiply(noise, rank),
-            gradient_noise,
-            ranks,
-        )
-        gradient = jax.tree_map(
-            lambda x: jnp.reshape(x, (sample_number, -1)),
-            gradient,
-        )
-        gradient = jax.tree_map(
-            lambda g, p: jnp.reshape(
-                -jnp.sum(g, axis=0) / (total_sample_number * self._config.sample_sigma),
-                p.shape,
-            ),
-            gradient,
-            parent,
-        )
-
-        # Adding regularisation
-        gradient = jax.tree_map(
-            lambda g, p: g + self._config.l2_coefficient * p,
-            gradient,
-            parent,
-        )
-
-        # Applying gradients
-        (offspring_update, optimizer_state) = self._optimizer.update(
-            gradient, optimizer_state
-        )
-        offspring = optax.apply_updates(parent, offspring_update)
-
-        return offspring, optimizer_state, random_key
-
     @partial(
         jax.jit,
         static_argnames=("self",),
@@ -430,21 +528,12 @@ class VanillaESEmitter(Emitter):
         # Updating novelty archive
         novelty_archive = emitter_state.novelty_archive.update(descriptors)
 
-        # Define scores for es process
-        def scores(fitnesses: Fitness, descriptors: Descriptor) -> jnp.ndarray:
-            if self._config.nses_emitter:
-                return novelty_archive.novelty(
-                    descriptors, self._config.novelty_nearest_neighbors
-                )
-            else:
-		return fitnesses
-
         # Run es process
-        offspring, optimizer_state, random_key = self._es_emitter(
+        offspring, optimizer_state, random_key = self._es_step(
             parent=genotypes,
             optimizer_state=emitter_state.optimizer_state,
             random_key=emitter_state.random_key,
-            scores_fn=scores,
+            novelty_archive=novelty_archive,
         )
 
         return emitter_state.replace(  # type: ignore
@@ -454,3 +543,144 @@ class VanillaESEmitter(Emitter):
             generation_count=emitter_state.generation_count + 1,
             random_key=random_key,
         )
+
+    def _one_step(
+        self,
+        emitter_state: VanillaESEmitterState,
+    ) -> VanillaESEmitterState:
+        """Run one full generation of the emitter: emit the current offspring,
+        evaluate it and update the emitter state.
+
+        Args:
+            emitter_state: current emitter state.
+
+        Returns:
+            The emitter state after one generation.
+        """
+
+        # Emitting and evaluating the current offspring
+        genotypes, random_key = self.emit(None, emitter_state, emitter_state.random_key)
+        fitnesses, descriptors, extra_scores, random_key = self._scoring_fn(
+            genotypes, random_key
+        )
+
+        return self.state_update(
+            emitter_state=emitter_state.replace(random_key=random_key),
+            repertoire=None,
+            genotypes=genotypes,
+            fitnesses=fitnesses,
+            descriptors=descriptors,
+            extra_scores=extra_scores,
+        )
+
+    @partial(
+        jax.jit,
+        static_argnames=("self", "num_generations"),
+    )
+    def run(
+        self,
+        emitter_state: VanillaESEmitterState,
+        num_generations: int,
+    ) -> VanillaESEmitterState:
+        """Run the emitter on its own for several generations, without any
+        repertoire, as a single jax.lax.scan.
+
+        Args:
+            emitter_state: initial emitter state.
+            num_generations: number of generations to run.
+
+        Returns:
+            The emitter state after num_generations generations.
+        """
+
+        def _scan_step(
+            emitter_state: VanillaESEmitterState, _: None
+        ) -> Tuple[VanillaESEmitterState, None]:
+            return self._one_step(emitter_state), None
+
+        emitter_state, _ = jax.lax.scan(
+            _scan_step, emitter_state, None, length=num_generations
+        )
+        return emitter_state
+
+    @partial(
+        jax.jit,
+        static_argnames=("self",),
+    )
+    def batched_init(
+        self, init_genotypes: Genotype, random_keys: RNGKey
+    ) -> Tuple[VanillaESEmitterState, RNGKey]:
+        """Initializes a batch of independent emitter states, one per random key,
+        to run several ES or NSES instances in parallel.
+
+        Args:
+            init_genotypes: The initial genotype of each instance, with shape
+                (num_instances, 1, ...), i.e. a batch of size 1 per instance.
+            random_keys: One random key per instance, e.g. obtained with
+                jax.random.split(random_key, num_instances).
+
+        Returns:
+            The batched initial states of the VanillaESEmitter, new random keys.
+        """
+
+        # Each instance requires one initial genotype with its batch dimension
+        for x in jax.tree_util.tree_leaves(init_genotypes):
+            assert x.ndim >= 2 and x.shape[1] == 1, (
+                "ERROR: batched Vanilla-ES requires init_genotypes of shape "
+                + "(num_instances, 1, ...), the inputed genotypes have shape:"
+                + str(x.shape)
+            )
+
+        return jax.vmap(self.init)(init_genotypes, random_keys)
+
+    @partial(
+        jax.jit,
+        static_argnames=("self",),
+    )
+    def batched_state_update(
+        self,
+        emitter_state: VanillaESEmitterState,
+        repertoire: MapElitesRepertoire,
+        genotypes: Genotype,
+        fitnesses: Fitness,
+        descriptors: Descriptor,
+        extra_scores: ExtraScores,
+    ) -> VanillaESEmitterState:
+        """Apply state_update to a batch of independent emitter states.
+
+        Args:
+            emitter_state: batched emitter states, from batched_init.
+            repertoire: unused, shared by all instances.
+            genotypes: the genotypes emitted by each instance.
+            fitnesses: the fitnesses of the offspring of each instance.
+            descriptors: the descriptors of the offspring of each instance.
+            extra_scores: the extra scores of the offspring of each instance.
+
+        Returns:
+            The modified batched emitter states.
+        """
+        return jax.vmap(self.state_update, in_axes=(0, None, 0, 0, 0, 0))(
+            emitter_state, repertoire, genotypes, fitnesses, descriptors, extra_scores
+        )
+
+    @partial(
+        jax.jit,
+        static_argnames=("self", "num_generations"),
+    )
+    def batched_run(
+        self,
+        emitter_state: VanillaESEmitterState,
+        num_generations: int,
+    ) -> VanillaESEmitterState:
+        """Apply run to a batch of independent emitter states.
+
+        Args:
+            emitter_state: batched emitter states, from batched_init.
+            num_generations: number of generations to run.
+
+        Returns:
+            The batched emitter states after num_generations generations.
+        """
+        return jax.vmap(partial(self.run, num_generations=num_generations))(
+            emitter_state
+        )
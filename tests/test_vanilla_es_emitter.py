@@ -0,0 +1,58 @@
+import jax
+import jax.numpy as jnp
+import numpy as np
+import pytest
+
+from src.training.vanilla_es_emitter import NoveltyArchive
+
+
+def pairwise_novelty(
+    descriptors: np.ndarray, archive: np.ndarray, num_valid: int, k: int
+) -> np.ndarray:
+    """Reference novelty, from the direct pairwise distances in float64."""
+    distances = np.sqrt(
+        np.sum(
+            np.square(descriptors[:, None, :] - archive[None, :num_valid, :]),
+            axis=-1,
+        )
+    )
+    return np.mean(np.sort(distances, axis=1)[:, : min(k, num_valid)], axis=1)
+
+
+@pytest.mark.parametrize("offset, spread", [(30.0, 1e-2), (0.5, 1e-3), (0.0, 1.0)])
+def test_novelty_matches_pairwise_distance(offset: float, spread: float) -> None:
+    size, num_filled, num_samples, k = 200, 150, 1000, 10
+    key_archive, key_samples = jax.random.split(jax.random.PRNGKey(0))
+
+    # Archive filled with the trajectory of a slowly moving parent, queried
+    # with es-samples tightly clustered around the latest parent
+    trajectory = offset + jnp.cumsum(
+        spread * jax.random.normal(key_archive, (num_filled, 2)), axis=0
+    )
+    descriptors = trajectory[-1] + spread * jax.random.normal(
+        key_samples, (num_samples, 2)
+    )
+    novelty_archive = NoveltyArchive.init(size, 2).update(trajectory)
+
+    novelty = novelty_archive.novelty(descriptors, k)
+
+    # The slot at position is empty but considered, as a zero descriptor
+    archive = np.concatenate([np.asarray(trajectory, np.float64), np.zeros((1, 2))])
+    expected = pairwise_novelty(
+        np.asarray(descriptors, np.float64), archive, num_filled + 1, k
+    )
+    np.testing.assert_allclose(novelty, expected, rtol=1e-5)
+    assert np.all(np.argsort(novelty) == np.argsort(expected))
+
+
+def test_novelty_after_wrap_around() -> None:
+    # Writing 6 descriptors in an archive of size 5 wraps around to position 1
+    novelty_archive = NoveltyArchive.init(5, 1).update(
+        jnp.array([[10.0], [11.0], [12.0], [13.0], [14.0], [15.0]])
+    )
+    assert novelty_archive.position == 1
+    assert novelty_archive.num_filled == 5
+
+    # All slots are valid, the archive content being [15, 11, 12, 13, 14]
+    novelty = novelty_archive.novelty(jnp.array([[12.0]]), 3)
+    np.testing.assert_allclose(novelty, [2.0 / 3.0], rtol=1e-6)